@@ -1,15 +1,436 @@
 import os
 import re
 import json
+import operator
 import asyncio
+import time
 from datetime import datetime
-from typing import List, Dict, Any, Optional
+from functools import lru_cache
+from typing import List, Dict, Any, Optional, AsyncIterator, Iterator
 from src.textHandler import TextHandler
 # Add import for MessageServiceType
 try:
     from pyrogram.enums import MessageServiceType
 except ImportError:
     MessageServiceType = None
+try:
+    from pyrogram.errors import FloodWait
+except ImportError:
+    class FloodWait(Exception):
+        value = 0
+# orjson is much faster than the stdlib encoder, fall back to json without it
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def _dump_json_bytes(data, indent: bool = False) -> bytes:
+    """Serialize data to UTF-8 JSON bytes, non-serializable values become str()"""
+    if orjson is not None:
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(data, option=option, default=str)
+    return json.dumps(data, indent=2 if indent else None, ensure_ascii=False, default=str).encode('utf-8')
+
+
+def _int_or_none(value) -> Optional[int]:
+    """Coerce counters and sizes to plain ints so the JSON encoder never meets a foreign type"""
+    return None if value is None else int(value)
+
+
+def _photo_info(photo) -> Dict:
+    """Media info of the largest photo size available"""
+    try:
+        sizes = photo.sizes
+    except AttributeError:
+        return {}
+    if not sizes:
+        return {}
+    largest = max(sizes, key=lambda s: getattr(s, "file_size", 0) or 0)
+    return {
+        'file_id': getattr(largest, 'file_id', None),
+        'file_size': _int_or_none(getattr(largest, 'file_size', None)),
+        'width': getattr(largest, 'width', None),
+        'height': getattr(largest, 'height', None)
+    }
+
+
+def _video_info(video) -> Dict:
+    return {'file_id': video.file_id, 'duration': video.duration, 'width': video.width, 'height': video.height, 'file_size': _int_or_none(video.file_size)}
+
+
+def _audio_info(audio) -> Dict:
+    return {'file_id': audio.file_id, 'duration': audio.duration, 'title': audio.title, 'performer': audio.performer, 'file_size': _int_or_none(audio.file_size)}
+
+
+def _voice_info(voice) -> Dict:
+    return {'file_id': voice.file_id, 'duration': voice.duration, 'file_size': _int_or_none(voice.file_size)}
+
+
+def _document_info(document) -> Dict:
+    return {'file_id': document.file_id, 'file_name': document.file_name, 'mime_type': document.mime_type, 'file_size': _int_or_none(document.file_size)}
+
+
+def _sticker_info(sticker) -> Dict:
+    return {'file_id': sticker.file_id, 'emoji': sticker.emoji, 'set_name': sticker.set_name}
+
+
+# Reads every exported MessageEntity field in a single C-level call
+_ENTITY_ATTRS = operator.attrgetter('type', 'offset', 'length', 'url')
+
+
+def _entities_to_list(entities) -> List[Dict]:
+    return [
+        {'type': str(entity_type), 'offset': offset, 'length': length, 'url': url}
+        for entity_type, offset, length, url in map(_ENTITY_ATTRS, entities)
+    ]
+
+
+# https://t.me/c/<internal id>/<message id> or https://t.me/<username>/<message id>
+_MESSAGE_LINK_RE = re.compile(r'https?://t\.me/(?:c/(?P<cid>\d+)|(?P<uname>[^/]+))/(?P<mid>\d+)')
+
+# Code point ranges treated as RTL, inclusive
+_RTL_RANGES = (
+    (0x0600, 0x06FF),  # Arabic
+    (0x0750, 0x077F),  # Arabic Supplement
+    (0x08A0, 0x08FF),  # Arabic Extended-A
+    (0xFB50, 0xFDFF),  # Arabic Presentation Forms-A
+    (0xFE70, 0xFEFF),  # Arabic Presentation Forms-B
+    (0x200F, 0x200F),  # RTL mark
+)
+_RTL_CHARS = '[' + ''.join(f'{chr(lo)}-{chr(hi)}' for lo, hi in _RTL_RANGES) + ']'
+_RTL_CHAR_RE = re.compile(_RTL_CHARS)
+# Leading whitespace followed by an RTL character, checked without copying the stripped text
+_LEADING_RTL_RE = re.compile(r'\s*' + _RTL_CHARS)
+
+
+@lru_cache(maxsize=4096)
+def _is_rtl(text: str) -> bool:
+    """Detect if the text is mostly Arabic/Persian and should be rendered RTL, cached since forwarded texts and captions repeat"""
+    # No RTL character can be ASCII, this covers most messages
+    if text.isascii():
+        return False
+    # Both counts run in C instead of a Python loop over every character
+    rtl_chars = len(_RTL_CHAR_RE.findall(text))
+    total_chars = sum(map(str.isalpha, text))
+    if total_chars == 0:
+        return False
+    # If first non-space char is RTL, or >40% of letters are RTL, treat as RTL
+    return _LEADING_RTL_RE.match(text) is not None or rtl_chars / total_chars > 0.4
+
+
+# Media attribute -> media_info builder, in the order the message is checked
+_MEDIA_EXTRACTORS = (
+    ('photo', _photo_info),
+    ('video', _video_info),
+    ('audio', _audio_info),
+    ('voice', _voice_info),
+    ('document', _document_info),
+    ('sticker', _sticker_info),
+)
+
+
+# Telegram requests in flight at once, shared by every fetch of an export
+_MAX_RPC_CONCURRENCY = 16
+# Media downloads in flight at once
+_MAX_DOWNLOAD_CONCURRENCY = 4
+# FloodWait retries before a request is given up
+_FLOOD_WAIT_RETRIES = 3
+
+_PROGRESS_BAR_LENGTH = 30
+_PROGRESS_BAR_FILLED = '█' * _PROGRESS_BAR_LENGTH
+_PROGRESS_BAR_EMPTY = '░' * _PROGRESS_BAR_LENGTH
+
+# Static assets shared by every HTML export, kept encoded so they are written as-is
+_EXPORT_CSS = "body {font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5;} h1 {color: #0088cc; text-align: center;} h2 {color: #333; border-bottom: 2px solid #0088cc; padding-bottom: 5px;} .export-info {background: #fff; padding: 15px; margin-bottom: 20px; border-radius: 5px; box-shadow: 0 2px 5px rgba(0,0,0,0.1);} .message {background: #fff; margin-bottom: 15px; padding: 15px; border-radius: 8px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); position: relative; transition: all 0.3s ease;} .service-message {background: #f8f9fa; border-left: 4px solid #6c757d; font-style: italic;} .message-header {font-size: 12px; color: #666; margin-bottom: 10px; border-bottom: 1px solid #eee; padding-bottom: 5px;} .message-text {line-height: 1.6; margin-bottom: 10px;} .service-text {color: #6c757d; font-weight: 500; text-align: center; padding: 10px;} .message-media {margin: 10px 0;} img {max-width: 100%; height: auto; border-radius: 5px;} video {max-width: 100%; height: auto; border-radius: 5px;} audio {width: 100%;} .media-file {background: #f9f9f9; padding: 10px; border-radius: 5px; margin: 5px 0;} .caption {font-style: italic; color: #666; margin-top: 10px;} .reply-info {background: #e8f4fd; border-left: 4px solid #0088cc; padding: 10px; margin: 10px 0; border-radius: 0 5px 5px 0; cursor: pointer; transition: background 0.2s ease;} .reply-info:hover {background: #d4edda;} .reply-preview {font-size: 14px; color: #555;} .json-toggle {background: #f0f0f0; border: 1px solid #ccc; padding: 5px 10px; border-radius: 3px; cursor: pointer; font-size: 12px; margin-top: 10px; display: inline-block;} .json-data {display: none; background: #2d2d2d; color: #f8f8f2; padding: 15px; border-radius: 5px; margin-top: 10px; font-family: monospace; font-size: 12px; white-space: pre-wrap; max-height: 300px; overflow-y: auto;} .stats {background: #e8f4fd; padding: 10px; border-radius: 5px; margin-top: 20px;} .media-info {font-size: 12px; color: #888; margin-top: 5px;} .highlight {background: #ffeb3b !important; border: 2px solid #ff9800 !important; transform: scale(1.02);} .reply-link {color: #0088cc; text-decoration: underline;}".encode('utf-8')
+_EXPORT_JS = "var jsonCache = null; var jsonCallbacks = null; function loadJsonData(callback) {if (jsonCache) {callback(jsonCache); return;} if (jsonCallbacks) {jsonCallbacks.push(callback); return;} var dataFile = document.body.getAttribute('data-messages-file'); if (!dataFile) {callback(null); return;} jsonCallbacks = [callback]; function done(cache) {var callbacks = jsonCallbacks; jsonCallbacks = null; jsonCache = cache; callbacks.forEach(function(cb) {cb(cache);});} var script = document.createElement('script'); script.src = dataFile; script.onload = function() {var cache = {}; (window.exportMessages || []).forEach(function(msg) {cache[msg.id] = msg;}); done(cache);}; script.onerror = function() {done(null);}; document.body.appendChild(script);} function toggleJson(id) {var elem = document.getElementById('json-' + id); if (elem.style.display === 'block') {elem.style.display = 'none'; return;} loadJsonData(function(cache) {if (cache && cache[id]) {elem.textContent = JSON.stringify(cache[id], null, 2);} else {elem.textContent = 'Could not load JSON data from ' + (document.body.getAttribute('data-messages-file') || 'the export data file') + ', keep it next to this HTML file.';} elem.style.display = 'block';});} function scrollToMessage(messageId) {var targetMsg = document.getElementById('msg-' + messageId); if (targetMsg) {targetMsg.scrollIntoView({behavior: 'smooth', block: 'center'}); targetMsg.classList.add('highlight'); setTimeout(function() {targetMsg.classList.remove('highlight');}, 1000);} else {alert('Replied message not found in this export range');}} window.onload = function() {document.querySelectorAll('.reply-info').forEach(function(elem) {elem.addEventListener('click', function() {var messageId = this.getAttribute('data-reply-to'); if (messageId) scrollToMessage(messageId);});});};".encode('utf-8')
+
+
+# Opening of a regular message block, up to and including its header line
+_MESSAGE_HEADER_TEMPLATE = '<div class="message" id="msg-{id}"><div class="message-header">Message ID: {id} | Date: {date} | From: {sender_info}{media_suffix}</div>'
+
+def _escape_text(text: str) -> str:
+    """Escape message text for the HTML export: angle brackets become entities, newlines become line breaks"""
+    # str.replace scans in C and returns the text itself when there is nothing to replace,
+    # it beats both a regex substitution and str.translate with multi-character replacements
+    return text.replace('<', '&lt;').replace('>', '&gt;').replace('\n', '<br>')
+
+
+def _render_image(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    return f'<div class="message-media"><img src="{src}" alt="Image"></div>'
+
+
+def _render_sticker(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    # Fixed sticker (static)
+    return f'<div class="message-media"><img src="{src}" alt="Sticker" style="max-width:128px;background:#eee;"><div class="media-info">Sticker (.webp)</div></div>'
+
+
+def _render_gif(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    return f'<div class="message-media"><img src="{src}" alt="GIF"></div>'
+
+
+def _render_video(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    # mp4/webm can be video, animated sticker, or gif (Telegram GIFs are mp4)
+    if media_type == 'sticker':
+        return f'<div class="message-media"><video autoplay loop muted playsinline style="background:#eee;max-width:128px;"><source src="{src}" type="video/{ext}">Your browser does not support animated stickers.</video><div class="media-info">Animated Sticker (.{ext})</div></div>'
+    return f'<div class="message-media"><video controls loop autoplay muted playsinline><source src="{src}" type="video/{ext}">Your browser does not support video or GIFs. (Telegram GIFs are mp4 files)</video></div>'
+
+
+def _render_tgs(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    # Lottie animation, not viewable in browser
+    return f'<div class="media-file">🗂️ <a href="{src}" target="_blank">{filename}</a> <span class="media-info">(Telegram animated sticker .tgs - not viewable in browser)</span></div>'
+
+
+def _render_audio(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    audio_type = "audio/ogg" if ext == "oga" else f"audio/{ext}"
+    return f'<div class="message-media"><audio controls><source src="{src}" type="{audio_type}">Your browser does not support audio.</audio></div>'
+
+
+def _render_file(src: str, filename: str, ext: str, media_type: Optional[str]) -> str:
+    return f'<div class="media-file">📁 <a href="{src}" target="_blank">{filename}</a></div>'
+
+
+def _gif_basenames(directory: str) -> set:
+    """Names without extension of the .gif files in directory, read with one scandir"""
+    try:
+        with os.scandir(directory) as entries:
+            return {entry.name[:-4] for entry in entries if entry.name.endswith('.gif')}
+    except OSError:
+        return set()
+
+
+_IMAGE_EXTS = frozenset({'jpg', 'jpeg', 'png'})
+_VIDEO_EXTS = frozenset({'mp4', 'webm'})
+_AUDIO_EXTS = frozenset({'mp3', 'wav', 'ogg', 'opus', 'oga'})
+
+# Lower-case file extension -> media fragment renderer, anything else is linked as a file
+_MEDIA_RENDERERS = {
+    **dict.fromkeys(_IMAGE_EXTS, _render_image),
+    'webp': _render_sticker,
+    **dict.fromkeys(_VIDEO_EXTS, _render_video),
+    'gif': _render_gif,
+    'tgs': _render_tgs,
+    **dict.fromkeys(_AUDIO_EXTS, _render_audio),
+}
+
+
+def _message_link(msg_id: int, start_link: str) -> str:
+    """Link to message msg_id in the chat of start_link"""
+    # Failed messages only know their id, the chat comes from the export's start link
+    match = _MESSAGE_LINK_RE.match(start_link)
+    if not match:
+        return f"Message ID: {msg_id}"
+    if match['cid']:
+        return f"https://t.me/c/{match['cid']}/{msg_id}"
+    return f"https://t.me/{match['uname']}/{msg_id}"
+
+
+def _relative_url(path: str, downloads_prefix: str) -> str:
+    """Path of an exported file relative to the export dir, with forward slashes for the HTML"""
+    if path.startswith(downloads_prefix):
+        path = path[len(downloads_prefix):]
+    else:
+        path = os.path.relpath(path, downloads_prefix)
+    return path.replace('\\', '/')
+
+
+def _render_pinned_info(msg_data: Dict) -> str:
+    """Details of a PINNED_MESSAGE service message, empty when nothing is known"""
+    # The original message object is only there if it was stored in msg_data
+    original_message = msg_data.get('original_message_obj')
+    try:
+        pinned_message = getattr(original_message, "pinned_message", None)
+        if pinned_message:
+            pinned_content = getattr(pinned_message, "text", None) or getattr(pinned_message, "caption", None) or ""
+            pinned_info = f'<div><b>Pinned Message ID:</b> {getattr(pinned_message, "id", None)}</div>'
+            if pinned_content:
+                pinned_info += f'<div><b>Pinned Content:</b> {pinned_content}</div>'
+            return pinned_info
+        if "pinned_message_id" in msg_data:
+            return f'<div><b>Pinned Message ID:</b> {msg_data["pinned_message_id"]}</div>'
+    except Exception:
+        pass
+    return ""
+
+
+def _render_new_members(msg_data: Dict) -> str:
+    """Details of a NEW_CHAT_MEMBERS service message, empty when nothing is known"""
+    original_message = msg_data.get('original_message_obj')
+    try:
+        members = getattr(original_message, "new_chat_members", None)
+        if members:
+            return "<div><b>New Members Joined:</b> " + ", ".join([getattr(u, "first_name", "Unknown") for u in members]) + "</div>"
+    except Exception:
+        pass
+    return ""
+
+
+# Service type -> renderer of extra details, other service types only show their text
+_SERVICE_DETAIL_RENDERERS = {
+    "PINNED_MESSAGE": _render_pinned_info,
+    "NEW_CHAT_MEMBERS": _render_new_members,
+}
+
+
+def _render_message(msg_data: Dict, media_lookup: Dict[int, str], message_ids: set, downloads_prefix: str, start_link: str, gif_names_by_dir: Dict[str, set]) -> str:
+    """Render the HTML block of one message"""
+    mid = msg_data['id']
+    # If this is an error/log placeholder, render with clickable failed link
+    error = msg_data.get('error')
+    if error is not None:
+        link = _message_link(mid, start_link)
+        return (
+            f'<div class="message" id="msg-{mid}" style="background:#ffeaea;border:1px solid #ff8888;">'
+            f'<div class="message-header" style="color:#b71c1c;">Message ID: {mid} | ERROR</div>'
+            f'<div class="message-text" style="color:#b71c1c;"><b>Error:</b> {error}</div>'
+            f'<div style="margin-top:10px;"><strong>Check manually:</strong> <a href="{link}" target="_blank" style="color:#0088cc;">{link}</a></div>'
+            f'</div>'
+        )
+
+    # Collect the fragments of one message and hand them out joined
+    parts = []
+    add = parts.append
+
+    # Handle service messages with special styling
+    if msg_data.get('is_service'):
+        service_text = msg_data.get('service_text', 'Service message')
+        service_type = msg_data.get('service_type', 'Unknown')
+        service_type_class = msg_data.get('service_type_class', '')
+        msg_date = msg_data.get('date', 'Unknown')
+        add(f'<div class="message service-message" id="msg-{mid}">')
+        add(
+            f'<div class="message-header">'
+            f'<b>Service Message</b> | ID: {mid} | Date: {msg_date} | '
+            f'<span style="color:#0088cc;">Type: {service_type}'
+        )
+        if service_type_class and service_type_class != service_type:
+            add(f' <span style="color:#888;">({service_type_class})</span>')
+        add('</span></div>')
+
+        # --- Show details for PINNED_MESSAGE and NEW_CHAT_MEMBERS ---
+        render_details = _SERVICE_DETAIL_RENDERERS.get(service_type)
+        if render_details is not None:
+            details = render_details(msg_data)
+            if details:
+                add(f'<div class="service-text" style="background:#e3f2fd;">{details}</div>')
+
+        add(f'<div class="service-text">{service_text}</div>')
+        # JSON toggle button, data is loaded from the JSON export on demand
+        add(f'<div class="json-toggle" onclick="toggleJson({mid})">Show/Hide JSON Data</div><div id="json-{mid}" class="json-data"></div></div>')
+        return ''.join(parts)
+
+    # Compose sender display: Name (id) [@username]
+    from_user = msg_data.get('from_user')
+    if from_user:
+        sender_name = from_user.get('first_name') or from_user.get('last_name') or from_user.get('username') or "Deleted Account"
+        sender_id = from_user.get('id')
+        sender_username = from_user.get('username')
+    else:
+        sender_name = "Deleted Account"
+        sender_id = None
+        sender_username = None
+
+    sender_info = sender_name
+    if sender_id is not None:
+        sender_info += f' (id: {sender_id})'
+    if sender_username:
+        sender_info += f' [@{sender_username}]'
+
+    msg_date = msg_data.get('date', 'Unknown')
+    media_type = msg_data.get('media_type')
+    
+    add(_MESSAGE_HEADER_TEMPLATE.format_map({
+        'id': mid,
+        'date': msg_date,
+        'sender_info': sender_info,
+        'media_suffix': f' | Media: {media_type}' if media_type else ''
+    }))
+    
+    # Show reply information with clickable functionality
+    reply = msg_data.get('reply_to')
+    if reply:
+        reply_msg_id = reply['message_id']
+        is_in_range = reply_msg_id in message_ids
+        
+        if is_in_range:
+            add(f'<div class="reply-info" data-reply-to="{reply_msg_id}" title="Click to scroll to replied message"><strong>↳ Replying to message {reply_msg_id}</strong> by {reply["from_user"]}<div class="reply-preview">{reply.get("text_preview", "")}</div></div>')
+        else:
+            add(f'<div class="reply-info"><strong>↳ Replying to message {reply_msg_id}</strong> by {reply["from_user"]} <span style="color:#888;">(not in export range)</span><div class="reply-preview">{reply.get("text_preview", "")}</div></div>')
+    
+    # Message text
+    text_content = msg_data.get('text') or msg_data.get('caption')
+    if text_content:
+        escaped_text = _escape_text(text_content)
+        # RTL detection
+        if _is_rtl(text_content):
+            add(f'<div class="message-text" dir="rtl" style="text-align:right">{escaped_text}</div>')
+        else:
+            add(f'<div class="message-text">{escaped_text}</div>')
+    
+    # Media content
+    media_path = media_lookup.get(mid)
+    if media_path is not None:
+        filename = os.path.basename(media_path)
+        _, dot, file_ext = filename.rpartition('.')
+        file_ext = file_ext.lower() if dot else ''
+        relative_path = _relative_url(media_path, downloads_prefix)
+
+        # --- Sticker and animation/gif support ---
+        # Fixed stickers are webp, animated stickers are webm, GIFs are gif/mp4 (prefer gif if available)
+        render = _MEDIA_RENDERERS.get(file_ext, _render_file)
+        if render is _render_video:
+            # Check if a .gif file exists for this media (same base name)
+            media_dir = os.path.dirname(media_path)
+            base_name = os.path.splitext(filename)[0]
+            if base_name in gif_names_by_dir[media_dir]:
+                render = _render_gif
+                relative_path = _relative_url(os.path.join(media_dir, base_name + ".gif"), downloads_prefix)
+        add(render(relative_path, filename, file_ext, media_type))
+
+        # Add media info
+        media_info = msg_data.get('media_info')
+        if media_info:
+            info_text = f"File size: {media_info.get('file_size', 'Unknown')}"
+            if media_info.get('duration'):
+                info_text += f" | Duration: {media_info['duration']}s"
+            add(f'<div class="media-info">{info_text}</div>')
+    
+    # Show reactions if present and not empty
+    reactions = msg_data.get('reactions')
+    if reactions:
+        add('<div class="message-reactions" style="margin-bottom:8px;">')
+        for reaction in reactions:
+            emoji = reaction.get('emoji', '')
+            count = reaction.get('count', 0)
+            chosen = reaction.get('chosen', False)
+            chosen_style = 'border:2px solid #0088cc;border-radius:50%;padding:2px;' if chosen else ''
+            add(f'<span style="display:inline-block;margin-right:8px;font-size:18px;{chosen_style}">{emoji} <span style="font-size:13px;color:#555;">{count}</span></span>')
+        add('</div>')
+
+    # JSON toggle button, data is loaded from the JSON export on demand
+    add(f'<div class="json-toggle" onclick="toggleJson({mid})">Show/Hide JSON Data</div><div id="json-{mid}" class="json-data"></div></div>')
+    return ''.join(parts)
+
+
+def _error_placeholder(msg_id, error: str, date=None) -> Dict:
+    """Placeholder for a message that could not be exported, error and log share one string"""
+    return {'id': msg_id, 'error': error, 'log': error, 'date': date}
+
+
+def _write_if_changed(path: str, content: bytes):
+    """Write content to path unless the file already holds exactly these bytes"""
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, 'rb') as f:
+                if f.read() == content:
+                    return
+    except OSError:
+        pass
+    with open(path, 'wb') as f:
+        f.write(content)
+
 
 class MessageExporter:
     def __init__(self, client):
@@ -17,12 +438,32 @@ class MessageExporter:
         self.exported_media = []
         self.total_messages = 0
         self.processed_messages = 0
+        self._last_progress_print = 0.0
+        self._reset_request_limits()
+
+    def _reset_request_limits(self):
+        """Create the request and download limits, once per export since semaphores bind to one event loop"""
+        self._rpc_semaphore = asyncio.Semaphore(_MAX_RPC_CONCURRENCY)
+        self._download_semaphore = asyncio.Semaphore(_MAX_DOWNLOAD_CONCURRENCY)
+
+    async def _limited_call(self, semaphore: asyncio.Semaphore, func, *args, **kwargs):
+        """Await func(*args, **kwargs) under semaphore, waiting out FloodWait errors"""
+        async with semaphore:
+            for attempt in range(_FLOOD_WAIT_RETRIES + 1):
+                try:
+                    return await func(*args, **kwargs)
+                except FloodWait as e:
+                    if attempt == _FLOOD_WAIT_RETRIES:
+                        raise
+                    # Keep the slot while waiting so the other requests back off too
+                    print(f"\nFlood wait: retrying in {e.value}s")
+                    await asyncio.sleep(e.value)
         
     async def export_message_range(self, start_link: str, end_link: str, downloads_dir: str = "downloads/exports") -> str:
         """Export messages between start_link and end_link and create HTML file with parallel processing"""
         try:
-            if not os.path.exists(downloads_dir):
-                os.makedirs(downloads_dir)
+            # Media is downloaded into media/, create it once up front
+            os.makedirs(os.path.join(downloads_dir, "media"), exist_ok=True)
                 
             # Parse links to get message IDs and chat info
             start_info = self._parse_message_link(start_link)
@@ -37,26 +478,32 @@ class MessageExporter:
             
             self.total_messages = end_msg_id - start_msg_id + 1
             self.processed_messages = 0
+            self._reset_request_limits()
             
             print(f"Starting export of {self.total_messages} messages...")
             
             # Get all messages in range with full JSON data using parallel processing
-            messages_data = await self._get_messages_with_json_parallel(chat_id, start_msg_id, end_msg_id)
+            # Fetched Message objects of media messages, reused for the downloads
+            fetched_messages = {}
+            messages_data = await self._get_messages_with_json_parallel(chat_id, start_msg_id, end_msg_id, fetched_messages=fetched_messages)
             
             print("Downloading media files...")
             # Download media files in parallel
-            media_files = await self._download_range_media_parallel(messages_data, downloads_dir)
+            media_files = await self._download_range_media_parallel(messages_data, downloads_dir, fetched_messages)
             
             print("Generating files...")
+            # One timestamp for every file of this export
+            now = datetime.now()
             # Create separate CSS and JS files
             self._create_css_file(downloads_dir)
             self._create_js_file(downloads_dir)
             
-            # Generate HTML file with external CSS/JS references
-            html_filename = self._generate_enhanced_html_export(messages_data, media_files, downloads_dir, start_link, end_link)
+            # Save JSON file and the script with the same messages, the HTML loads per-message JSON data from the script
+            self._save_json_export(messages_data, downloads_dir, now)
+            data_filename = self._save_data_script(messages_data, downloads_dir, now)
             
-            # Also save JSON file
-            json_filename = self._save_json_export(messages_data, downloads_dir)
+            # Generate HTML file with external CSS/JS references
+            html_filename = self._generate_enhanced_html_export(messages_data, media_files, downloads_dir, start_link, end_link, data_filename, now)
             
             return html_filename
         except Exception as e:
@@ -64,81 +511,69 @@ class MessageExporter:
             print(f"Critical export error: {e}")
             return self._create_emergency_html(start_link, end_link, str(e), downloads_dir)
 
-    async def _get_messages_with_json_parallel(self, chat_id: str, start_msg_id: int, end_msg_id: int, batch_size: int = 10) -> List[Dict]:
+    async def _get_messages_with_json_parallel(self, chat_id: str, start_msg_id: int, end_msg_id: int, chunk_size: int = 200, fetched_messages: Optional[Dict[int, Any]] = None) -> List[Dict]:
         """Get messages with complete JSON data and reply information using parallel processing"""
         all_message_ids = list(range(start_msg_id, end_msg_id + 1))
-        messages_data = []
-        
-        # Process messages in batches
-        for i in range(0, len(all_message_ids), batch_size):
-            batch_ids = all_message_ids[i:i + batch_size]
-            
-            # Create tasks for parallel processing
-            tasks = [self._get_single_message_with_json(chat_id, msg_id) for msg_id in batch_ids]
-            
-            # Execute batch in parallel
-            batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Process results
-            for msg_id, result in zip(batch_ids, batch_results):
-                if isinstance(result, Exception):
-                    messages_data.append({
-                        'id': msg_id,
-                        'error': f"Could not get message {msg_id}: {result}",
-                        'log': f"Could not get message {msg_id}: {result}",
-                        'date': None
-                    })
-                else:
-                    messages_data.append(result)
-                
-                self.processed_messages += 1
-                self._print_progress("Fetching messages")
+        chunks = [all_message_ids[i:i + chunk_size] for i in range(0, len(all_message_ids), chunk_size)]
+
+        async def fetch(chunk_ids: List[int]) -> List[Dict]:
+            result = await self._get_message_chunk_with_json(chat_id, chunk_ids, fetched_messages)
+            self.processed_messages += len(chunk_ids)
+            self._print_progress("Fetching messages", self.processed_messages, self.total_messages)
+            return result
+
+        results = await asyncio.gather(*[fetch(chunk_ids) for chunk_ids in chunks], return_exceptions=True)
+
+        # Ids are contiguous, so every chunk has a fixed slot and no sort is needed
+        messages_data = [None] * len(all_message_ids)
+        for chunk_ids, result in zip(chunks, results):
+            offset = chunk_ids[0] - start_msg_id
+            if isinstance(result, Exception):
+                reason = str(result)
+                result = [_error_placeholder(msg_id, f"Could not get message {msg_id}: {reason}") for msg_id in chunk_ids]
+            messages_data[offset:offset + len(chunk_ids)] = result
         
-        # Sort messages by ID to maintain order
-        messages_data.sort(key=lambda x: x['id'])
+        await self._attach_reply_info(chat_id, messages_data)
         return messages_data
 
-    async def _get_single_message_with_json(self, chat_id: str, msg_id: int) -> Dict:
-        """Get a single message with JSON data"""
+    async def _get_message_chunk_with_json(self, chat_id: str, chunk_ids: List[int], fetched_messages: Optional[Dict[int, Any]] = None) -> List[Dict]:
+        """Get a chunk of messages with JSON data using a single get_messages call.
+        Message objects with media are stored in fetched_messages when it is given."""
         try:
-            message = await self.client.get_messages(chat_id=chat_id, message_ids=msg_id)
-            if message and not message.empty:
-                try:
-                    # Convert message to dict and add extra metadata
-                    msg_dict = self._message_to_dict(message)
-                    # Add reply information
-                    reply_info = await self._get_reply_info(message)
-                    if reply_info:
-                        msg_dict['reply_to'] = reply_info
-                    # Try to make it JSON serializable (test only, not for saving)
-                    json.dumps(msg_dict, ensure_ascii=False, default=str)
-                    return msg_dict
-                except Exception as e:
-                    # If serialization fails, add error placeholder
-                    return {
-                        'id': msg_id,
-                        'error': f"Could not serialize message {msg_id}: {e}",
-                        'log': f"Could not serialize message {msg_id}: {e}",
-                        'date': getattr(message, "date", None)
-                    }
-            else:
-                # Message is empty or not found
-                return {
-                    'id': msg_id,
-                    'error': f"Message {msg_id} not found or is empty.",
-                    'log': f"Message {msg_id} not found or is empty.",
-                    'date': None
-                }
+            # get_messages accepts up to 200 ids per request, replies are fetched
+            # separately in bulk by _attach_reply_info
+            messages = await self._limited_call(self._rpc_semaphore, self.client.get_messages, chat_id=chat_id, message_ids=chunk_ids, replies=0)
         except Exception as e:
-            # Log the error for this message and continue
-            return {
-                'id': msg_id,
-                'error': f"Could not get message {msg_id}: {e}",
-                'log': f"Could not get message {msg_id}: {e}",
-                'date': None
-            }
+            # Log the error for every message of this chunk and continue
+            reason = str(e)
+            return [_error_placeholder(msg_id, f"Could not get message {msg_id}: {reason}") for msg_id in chunk_ids]
+        # Match results by id, a short or reordered reply must not shift messages onto other ids
+        messages_by_id = {message.id: message for message in messages if message is not None}
+        # Convert in a worker thread so the event loop keeps serving the other requests
+        chunk_data = await asyncio.get_running_loop().run_in_executor(None, self._build_chunk_json, chunk_ids, messages_by_id)
+        if fetched_messages is not None:
+            for msg_dict in chunk_data:
+                if msg_dict.get('media_type'):
+                    fetched_messages[msg_dict['id']] = messages_by_id[msg_dict['id']]
+        return chunk_data
+
+    def _build_chunk_json(self, chunk_ids: List[int], messages_by_id: Dict[int, Any]) -> List[Dict]:
+        """Convert a fetched chunk of messages to JSON dicts, one per requested id"""
+        return [self._build_message_json(msg_id, messages_by_id.get(msg_id)) for msg_id in chunk_ids]
+
+    def _build_message_json(self, msg_id: int, message) -> Dict:
+        """Convert a fetched message to its JSON dict, or an error placeholder"""
+        if message and not message.empty:
+            try:
+                # Convert message to dict and add extra metadata
+                return self._message_to_dict(message)
+            except Exception as e:
+                # If conversion fails, add error placeholder
+                return _error_placeholder(msg_id, f"Could not serialize message {msg_id}: {e}", getattr(message, "date", None))
+        # Message is empty or not found
+        return _error_placeholder(msg_id, f"Message {msg_id} not found or is empty.")
 
-    async def _download_range_media_parallel(self, messages_data: List[Dict], downloads_dir: str, batch_size: int = 5) -> List[Dict]:
+    async def _download_range_media_parallel(self, messages_data: List[Dict], downloads_dir: str, fetched_messages: Optional[Dict[int, Any]] = None) -> List[Dict]:
         """Download media files for all messages using parallel processing"""
         media_messages = [msg for msg in messages_data if msg.get('media_type') and 'error' not in msg]
         media_files = []
@@ -148,76 +583,73 @@ class MessageExporter:
             return media_files
         
         print(f"Found {len(media_messages)} messages with media")
-        
-        # Process media downloads in smaller batches to avoid overwhelming the client
-        for i in range(0, len(media_messages), batch_size):
-            batch = media_messages[i:i + batch_size]
-            
-            # Create tasks for parallel media download
-            tasks = [self._download_single_media(msg_data, downloads_dir) for msg_data in batch]
-            
-            # Execute batch in parallel
-            batch_results = await asyncio.gather(*tasks, return_exceptions=True)
-            
-            # Process results
-            for msg_data, result in zip(batch, batch_results):
-                if isinstance(result, Exception):
-                    print(f"Failed to download media for message {msg_data['id']}: {result}")
-                elif result:
-                    media_files.append(result)
-                
+
+        async def download(msg_data: Dict) -> Optional[Dict]:
+            nonlocal processed_media
+            try:
+                # The download semaphore keeps the client from being overwhelmed
+                return await self._download_single_media(msg_data, downloads_dir, fetched_messages.get(msg_data['id']) if fetched_messages else None)
+            finally:
                 processed_media += 1
-                self._print_progress(f"Downloading media ({processed_media}/{len(media_messages)})")
+                self._print_progress("Downloading media", processed_media, len(media_messages))
+
+        results = await asyncio.gather(*[download(msg_data) for msg_data in media_messages], return_exceptions=True)
+        
+        # Process results
+        for msg_data, result in zip(media_messages, results):
+            if isinstance(result, Exception):
+                print(f"Failed to download media for message {msg_data['id']}: {result}")
+            elif result:
+                media_files.append(result)
         
         return media_files
 
-    async def _download_single_media(self, msg_data: Dict, downloads_dir: str) -> Optional[Dict]:
-        """Download media for a single message"""
+    async def _download_single_media(self, msg_data: Dict, downloads_dir: str, message=None) -> Optional[Dict]:
+        """Download media for a single message, reusing the already fetched message if given"""
         try:
-            # Reconstruct message for download
-            message = await self.client.get_messages(chat_id=msg_data['chat_id'], message_ids=msg_data['id'])
+            if message is None:
+                # Reconstruct message for download
+                message = await self._limited_call(self._rpc_semaphore, self.client.get_messages, chat_id=msg_data['chat_id'], message_ids=msg_data['id'])
             if message and not message.empty:
-                media_path = await self.client.download_media(message, file_name=f"{downloads_dir}/media/")
+                media_path = await self._limited_call(self._download_semaphore, self.client.download_media, message, file_name=f"{downloads_dir}/media/")
                 if media_path:
                     return {'message_id': msg_data['id'], 'path': media_path}
         except Exception as e:
             raise Exception(f"Could not download media for message {msg_data['id']}: {e}")
         return None
 
-    def _print_progress(self, operation: str):
-        """Print progress bar for current operation"""
-        if self.total_messages > 0:
-            percentage = (self.processed_messages / self.total_messages) * 100
-            bar_length = 30
-            filled_length = int(bar_length * percentage // 100)
-            bar = '█' * filled_length + '░' * (bar_length - filled_length)
-            print(f"\r{operation}: [{bar}] {percentage:.1f}% ({self.processed_messages}/{self.total_messages})", end='', flush=True)
-            if self.processed_messages == self.total_messages:
+    def _print_progress(self, operation: str, done: int, total: int):
+        """Print progress bar for current operation, at most every 0.1s until complete"""
+        if total > 0:
+            complete = done == total
+            now = time.monotonic()
+            if not complete and now - self._last_progress_print < 0.1:
+                return
+            self._last_progress_print = now
+            percentage = (done / total) * 100
+            filled_length = int(_PROGRESS_BAR_LENGTH * percentage // 100)
+            bar = _PROGRESS_BAR_FILLED[:filled_length] + _PROGRESS_BAR_EMPTY[filled_length:]
+            print(f"\r{operation}: [{bar}] {percentage:.1f}% ({done}/{total})", end='', flush=True)
+            if complete:
                 print()  # New line when complete
 
     def _create_css_file(self, downloads_dir: str):
         """Create separate CSS file"""
-        css_content = "body {font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5;} h1 {color: #0088cc; text-align: center;} h2 {color: #333; border-bottom: 2px solid #0088cc; padding-bottom: 5px;} .export-info {background: #fff; padding: 15px; margin-bottom: 20px; border-radius: 5px; box-shadow: 0 2px 5px rgba(0,0,0,0.1);} .message {background: #fff; margin-bottom: 15px; padding: 15px; border-radius: 8px; box-shadow: 0 1px 3px rgba(0,0,0,0.1); position: relative; transition: all 0.3s ease;} .service-message {background: #f8f9fa; border-left: 4px solid #6c757d; font-style: italic;} .message-header {font-size: 12px; color: #666; margin-bottom: 10px; border-bottom: 1px solid #eee; padding-bottom: 5px;} .message-text {line-height: 1.6; margin-bottom: 10px;} .service-text {color: #6c757d; font-weight: 500; text-align: center; padding: 10px;} .message-media {margin: 10px 0;} img {max-width: 100%; height: auto; border-radius: 5px;} video {max-width: 100%; height: auto; border-radius: 5px;} audio {width: 100%;} .media-file {background: #f9f9f9; padding: 10px; border-radius: 5px; margin: 5px 0;} .caption {font-style: italic; color: #666; margin-top: 10px;} .reply-info {background: #e8f4fd; border-left: 4px solid #0088cc; padding: 10px; margin: 10px 0; border-radius: 0 5px 5px 0; cursor: pointer; transition: background 0.2s ease;} .reply-info:hover {background: #d4edda;} .reply-preview {font-size: 14px; color: #555;} .json-toggle {background: #f0f0f0; border: 1px solid #ccc; padding: 5px 10px; border-radius: 3px; cursor: pointer; font-size: 12px; margin-top: 10px; display: inline-block;} .json-data {display: none; background: #2d2d2d; color: #f8f8f2; padding: 15px; border-radius: 5px; margin-top: 10px; font-family: monospace; font-size: 12px; white-space: pre-wrap; max-height: 300px; overflow-y: auto;} .stats {background: #e8f4fd; padding: 10px; border-radius: 5px; margin-top: 20px;} .media-info {font-size: 12px; color: #888; margin-top: 5px;} .highlight {background: #ffeb3b !important; border: 2px solid #ff9800 !important; transform: scale(1.02);} .reply-link {color: #0088cc; text-decoration: underline;}"
-        css_path = os.path.join(downloads_dir, "export_styles.css")
-        with open(css_path, 'w', encoding='utf-8') as f:
-            f.write(css_content)
+        _write_if_changed(os.path.join(downloads_dir, "export_styles.css"), _EXPORT_CSS)
 
     def _create_js_file(self, downloads_dir: str):
         """Create separate JavaScript file"""
-        js_content = "function toggleJson(id) {var elem = document.getElementById('json-' + id); elem.style.display = elem.style.display === 'none' ? 'block' : 'none';} function scrollToMessage(messageId) {var targetMsg = document.getElementById('msg-' + messageId); if (targetMsg) {targetMsg.scrollIntoView({behavior: 'smooth', block: 'center'}); targetMsg.classList.add('highlight'); setTimeout(function() {targetMsg.classList.remove('highlight');}, 1000);} else {alert('Replied message not found in this export range');}} window.onload = function() {document.querySelectorAll('.reply-info').forEach(function(elem) {elem.addEventListener('click', function() {var messageId = this.getAttribute('data-reply-to'); if (messageId) scrollToMessage(messageId);});});};"
-        js_path = os.path.join(downloads_dir, "export_scripts.js")
-        with open(js_path, 'w', encoding='utf-8') as f:
-            f.write(js_content)
+        _write_if_changed(os.path.join(downloads_dir, "export_scripts.js"), _EXPORT_JS)
 
     def _create_emergency_html(self, start_link: str, end_link: str, error_msg: str, downloads_dir: str) -> str:
         """Create emergency HTML file when export completely fails"""
         try:
-            if not os.path.exists(downloads_dir):
-                os.makedirs(downloads_dir)
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            os.makedirs(downloads_dir, exist_ok=True)
+            now = datetime.now()
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
             html_filename = f"telegram_export_emergency_{timestamp}.html"
             html_path = os.path.join(downloads_dir, html_filename)
-            emergency_html = f'<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Telegram Export - Emergency</title><style>body {{font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5;}} .emergency {{background: #fff; padding: 20px; border-radius: 5px; border-left: 4px solid #e74c3c;}} .info {{background: #fff; padding: 15px; margin-top: 20px; border-radius: 5px; border-left: 4px solid #3498db;}}</style></head><body><div class="emergency"><h2>⚠️ Export Emergency Recovery</h2><p><strong>The export process encountered a critical error, but this HTML file was created to preserve your request.</strong></p><p><strong>Start Link:</strong> {start_link}</p><p><strong>End Link:</strong> {end_link}</p><p><strong>Error Details:</strong> {error_msg}</p><p><strong>Generated:</strong> {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p></div><div class="info"><h3>📋 Troubleshooting</h3><ul><li>Check if the message links are valid and accessible</li><li>Ensure you have access to the chat/channel</li><li>Try exporting a smaller range of messages</li><li>Check your internet connection</li><li>Restart the application and try again</li></ul></div></body></html>'
+            emergency_html = f'<!DOCTYPE html><html><head><meta charset="UTF-8"><title>Telegram Export - Emergency</title><style>body {{font-family: Arial, sans-serif; margin: 20px; background: #f5f5f5;}} .emergency {{background: #fff; padding: 20px; border-radius: 5px; border-left: 4px solid #e74c3c;}} .info {{background: #fff; padding: 15px; margin-top: 20px; border-radius: 5px; border-left: 4px solid #3498db;}}</style></head><body><div class="emergency"><h2>⚠️ Export Emergency Recovery</h2><p><strong>The export process encountered a critical error, but this HTML file was created to preserve your request.</strong></p><p><strong>Start Link:</strong> {start_link}</p><p><strong>End Link:</strong> {end_link}</p><p><strong>Error Details:</strong> {error_msg}</p><p><strong>Generated:</strong> {now.strftime("%Y-%m-%d %H:%M:%S")}</p></div><div class="info"><h3>📋 Troubleshooting</h3><ul><li>Check if the message links are valid and accessible</li><li>Ensure you have access to the chat/channel</li><li>Try exporting a smaller range of messages</li><li>Check your internet connection</li><li>Restart the application and try again</li></ul></div></body></html>'
             with open(html_path, 'w', encoding='utf-8') as f:
                 f.write(emergency_html)
             return html_filename
@@ -227,8 +659,7 @@ class MessageExporter:
 
     async def export_json_only(self, start_link: str, end_link: str, downloads_dir: str = "downloads/exports") -> str:
         """Export only JSON data without downloading media"""
-        if not os.path.exists(downloads_dir):
-            os.makedirs(downloads_dir)
+        os.makedirs(downloads_dir, exist_ok=True)
             
         start_info = self._parse_message_link(start_link)
         end_info = self._parse_message_link(end_link)
@@ -239,66 +670,35 @@ class MessageExporter:
         chat_id = start_info['chat_id']
         start_msg_id = min(start_info['message_id'], end_info['message_id'])
         end_msg_id = max(start_info['message_id'], end_info['message_id'])
+        self._reset_request_limits()
         
-        messages_data = await self._get_messages_with_json(chat_id, start_msg_id, end_msg_id)
-        json_filename = self._save_json_export(messages_data, downloads_dir)
+        # Messages are written as they arrive, so memory stays bounded by one chunk
+        messages = self._iter_messages_with_json(chat_id, start_msg_id, end_msg_id)
+        json_filename = await self._save_json_export_stream(messages, end_msg_id - start_msg_id + 1, downloads_dir)
         
         return json_filename
 
-    async def _get_messages_with_json(self, chat_id: str, start_msg_id: int, end_msg_id: int) -> List[Dict]:
-        """Get messages with complete JSON data and reply information"""
-        messages_data = []
-        
-        for msg_id in range(start_msg_id, end_msg_id + 1):
-            try:
-                message = await self.client.get_messages(chat_id=chat_id, message_ids=msg_id)
-                if message and not message.empty:
-                    try:
-                        # Convert message to dict and add extra metadata
-                        msg_dict = self._message_to_dict(message)
-                        # Add reply information
-                        reply_info = await self._get_reply_info(message)
-                        if reply_info:
-                            msg_dict['reply_to'] = reply_info
-                        # Try to make it JSON serializable (test only, not for saving)
-                        json.dumps(msg_dict, ensure_ascii=False, default=str)
-                        messages_data.append(msg_dict)
-                    except Exception as e:
-                        # If serialization fails, add error placeholder
-                        messages_data.append({
-                            'id': msg_id,
-                            'error': f"Could not serialize message {msg_id}: {e}",
-                            'log': f"Could not serialize message {msg_id}: {e}",
-                            'date': getattr(message, "date", None)
-                        })
-                else:
-                    # Message is empty or not found
-                    messages_data.append({
-                        'id': msg_id,
-                        'error': f"Message {msg_id} not found or is empty.",
-                        'log': f"Message {msg_id} not found or is empty.",
-                        'date': None
-                    })
-            except Exception as e:
-                # Log the error for this message and continue
-                messages_data.append({
-                    'id': msg_id,
-                    'error': f"Could not get message {msg_id}: {e}",
-                    'log': f"Could not get message {msg_id}: {e}",
-                    'date': None
-                })
-                continue
-        
-        return messages_data
+    async def _iter_messages_with_json(self, chat_id: str, start_msg_id: int, end_msg_id: int, chunk_size: int = 200) -> AsyncIterator[Dict]:
+        """Yield messages with complete JSON data in id order, fetching them in bulk chunks"""
+        for chunk_start in range(start_msg_id, end_msg_id + 1, chunk_size):
+            chunk_ids = list(range(chunk_start, min(chunk_start + chunk_size, end_msg_id + 1)))
+            chunk_data = await self._get_message_chunk_with_json(chat_id, chunk_ids)
+            await self._attach_reply_info(chat_id, chunk_data)
+            for msg_dict in chunk_data:
+                yield msg_dict
 
     def _message_to_dict(self, message) -> Dict:
         """Convert Pyrogram message object to dictionary with all available data"""
+        chat = message.chat
+        user = message.from_user
+        date = message.date
+        edit_date = message.edit_date
         msg_dict = {
             'id': message.id,
-            'date': message.date.isoformat() if message.date else None,
-            'chat_id': getattr(message.chat, 'id', None) if message.chat else None,
-            'chat_title': getattr(message.chat, 'title', None) if message.chat else None,
-            'chat_username': getattr(message.chat, 'username', None) if message.chat else None,
+            'date': date.isoformat() if date else None,
+            'chat_id': chat.id if chat else None,
+            'chat_title': chat.title if chat else None,
+            'chat_username': chat.username if chat else None,
             'from_user': None,
             'text': message.text,
             'caption': message.caption,
@@ -306,8 +706,8 @@ class MessageExporter:
             'media_info': {},
             'reply_to_message_id': message.reply_to_message_id,
             'forward_from': None,
-            'edit_date': message.edit_date.isoformat() if message.edit_date else None,
-            'views': getattr(message, 'views', None),
+            'edit_date': edit_date.isoformat() if edit_date else None,
+            'views': _int_or_none(message.views),
             'entities': [],
             'caption_entities': [],
             'reactions': [],
@@ -317,15 +717,16 @@ class MessageExporter:
         }
         
         # Check if this is a service message
-        if TextHandler.is_service_message(message):
+        service = message.service
+        if service is not None:
             msg_dict['is_service'] = True
             # Try to get the enum type if available
             service_type_name = None
-            service_type_class = type(message.service).__name__ if message.service else None
-            if hasattr(message.service, "type"):
+            service_type_class = type(service).__name__
+            if hasattr(service, "type"):
                 # If it's a Pyrogram MessageServiceType enum, get its name
                 try:
-                    service_type_enum = message.service.type
+                    service_type_enum = service.type
                     if hasattr(service_type_enum, "name"):
                         service_type_name = service_type_enum.name
                     else:
@@ -337,148 +738,129 @@ class MessageExporter:
             msg_dict['service_text'] = TextHandler.extract_service_message_text(message)
         
         # Add user information
-        if message.from_user:
+        if user:
             msg_dict['from_user'] = {
-                'id': message.from_user.id,
-                'first_name': message.from_user.first_name,
-                'last_name': message.from_user.last_name,
-                'username': message.from_user.username,
-                'is_bot': message.from_user.is_bot
+                'id': user.id,
+                'first_name': user.first_name,
+                'last_name': user.last_name,
+                'username': user.username,
+                'is_bot': user.is_bot
             }
 
-        # Add media information (use sizes for photo)
-        if message.photo:
-            # Use the largest size available
-            if hasattr(message.photo, "sizes") and message.photo.sizes:
-                largest = max(message.photo.sizes, key=lambda s: getattr(s, "file_size", 0) or 0)
-                msg_dict['media_type'] = 'photo'
-                msg_dict['media_info'] = {
-                    'file_id': getattr(largest, 'file_id', None),
-                    'file_size': getattr(largest, 'file_size', None),
-                    'width': getattr(largest, 'width', None),
-                    'height': getattr(largest, 'height', None)
-                }
-            else:
-                msg_dict['media_type'] = 'photo'
-                msg_dict['media_info'] = {}
-        elif message.video:
-            msg_dict['media_type'] = 'video'
-            msg_dict['media_info'] = {'file_id': message.video.file_id, 'duration': message.video.duration, 'width': message.video.width, 'height': message.video.height, 'file_size': getattr(message.video, 'file_size', None)}
-        elif message.audio:
-            msg_dict['media_type'] = 'audio'
-            msg_dict['media_info'] = {'file_id': message.audio.file_id, 'duration': message.audio.duration, 'title': message.audio.title, 'performer': message.audio.performer, 'file_size': getattr(message.audio, 'file_size', None)}
-        elif message.voice:
-            msg_dict['media_type'] = 'voice'
-            msg_dict['media_info'] = {'file_id': message.voice.file_id, 'duration': message.voice.duration, 'file_size': getattr(message.voice, 'file_size', None)}
-        elif message.document:
-            msg_dict['media_type'] = 'document'
-            msg_dict['media_info'] = {'file_id': message.document.file_id, 'file_name': message.document.file_name, 'mime_type': message.document.mime_type, 'file_size': getattr(message.document, 'file_size', None)}
-        elif message.sticker:
-            msg_dict['media_type'] = 'sticker'
-            msg_dict['media_info'] = {'file_id': message.sticker.file_id, 'emoji': message.sticker.emoji, 'set_name': getattr(message.sticker, 'set_name', None)}
+        # Add media information, the first media attribute set on the message wins
+        for media_type, extract_media_info in _MEDIA_EXTRACTORS:
+            media = getattr(message, media_type, None)
+            if media:
+                msg_dict['media_type'] = media_type
+                msg_dict['media_info'] = extract_media_info(media)
+                break
 
         # Add entities if present
-        if message.entities:
-            msg_dict['entities'] = [{'type': e.type, 'offset': e.offset, 'length': e.length, 'url': getattr(e, 'url', None)} for e in message.entities]
+        entities = message.entities
+        if entities:
+            msg_dict['entities'] = _entities_to_list(entities)
         
-        if message.caption_entities:
-            msg_dict['caption_entities'] = [{'type': e.type, 'offset': e.offset, 'length': e.length, 'url': getattr(e, 'url', None)} for e in message.caption_entities]
+        caption_entities = message.caption_entities
+        if caption_entities:
+            msg_dict['caption_entities'] = _entities_to_list(caption_entities)
         
         # Add forward information using forward_origin only
-        if hasattr(message, 'forward_origin') and message.forward_origin:
-            if hasattr(message.forward_origin, 'sender_user'):
+        forward_origin = getattr(message, 'forward_origin', None)
+        if forward_origin:
+            sender_user = getattr(forward_origin, 'sender_user', None)
+            sender_chat = getattr(forward_origin, 'sender_chat', None)
+            if sender_user is not None:
                 msg_dict['forward_from'] = {
-                    'user_id': message.forward_origin.sender_user.id,
-                    'first_name': message.forward_origin.sender_user.first_name,
-                    'username': message.forward_origin.sender_user.username
+                    'user_id': sender_user.id,
+                    'first_name': sender_user.first_name,
+                    'username': sender_user.username
                 }
-            elif hasattr(message.forward_origin, 'sender_chat'):
+            elif sender_chat is not None:
                 msg_dict['forward_from'] = {
-                    'chat_id': message.forward_origin.sender_chat.id,
-                    'chat_title': message.forward_origin.sender_chat.title,
-                    'chat_username': message.forward_origin.sender_chat.username
+                    'chat_id': sender_chat.id,
+                    'chat_title': sender_chat.title,
+                    'chat_username': sender_chat.username
                 }
         # ...do not use deprecated forward_from or forward_from_chat...
 
         # Add reactions if present (Pyrogram >=2.0)
+        if message.reactions:
+            msg_dict['reactions'] = self._extract_reactions(message)
+
+        return msg_dict
+
+    def _extract_reactions(self, message) -> List[Dict]:
+        """Get reaction emojis and counts, marking the ones sent by the current user"""
+        reactions = message.reactions
+        # Try .results (new Pyrogram), then .reactions (fork/older Pyrogram)
+        try:
+            reaction_list = reactions.results
+        except AttributeError:
+            reaction_list = None
+        if not reaction_list:
+            reaction_list = getattr(reactions, "reactions", None) or []
+        outgoing_emojis = frozenset(getattr(r, "emoji", None) for r in getattr(message, "outgoing_reaction", None) or ())
+        extract_emoji = self._extract_reaction_emoji
+        # extract_emoji never returns None, so the None a missing outgoing emoji adds cannot match
+        return [
+            {'emoji': (emoji := extract_emoji(reaction)), 'count': getattr(reaction, "count", None), 'chosen': emoji in outgoing_emojis}
+            for reaction in reaction_list
+        ]
+
+    def _extract_reaction_emoji(self, reaction) -> str:
+        """Get the emoji of a reaction, or a placeholder for custom/unknown ones"""
         try:
-            outgoing_emojis = set()
-            if hasattr(message, "outgoing_reaction") and message.outgoing_reaction:
-                for r in message.outgoing_reaction:
-                    emoji = getattr(r, "emoji", None)
-                    if emoji:
-                        outgoing_emojis.add(emoji)
-            if hasattr(message, "reactions") and message.reactions:
-                # Try .results (new Pyrogram)
-                if hasattr(message.reactions, "results") and message.reactions.results:
-                    for reaction in message.reactions.results:
-                        emoji = getattr(reaction.reaction, "emoji", None)
-                        if not emoji:
-                            custom_emoji_id = getattr(reaction.reaction, "custom_emoji_id", None)
-                            if custom_emoji_id:
-                                emoji = f"[custom:{custom_emoji_id}]"
-                        if not emoji:
-                            emoji = "[unknown]"
-                        count = getattr(reaction, "count", None)
-                        chosen = emoji in outgoing_emojis
-                        msg_dict['reactions'].append({
-                            'emoji': emoji,
-                            'count': count,
-                            'chosen': chosen
-                        })
-                # Try .reactions (fork/older Pyrogram)
-                elif hasattr(message.reactions, "reactions") and message.reactions.reactions:
-                    for reaction in message.reactions.reactions:
-                        # --- FIX: get emoji from reaction.type.emoji ---
-                        emoji = None
-                        if hasattr(reaction, "type") and hasattr(reaction.type, "emoji"):
-                            emoji = getattr(reaction.type, "emoji", None)
-                        if not emoji:
-                            custom_emoji_id = getattr(getattr(reaction, "type", None), "custom_emoji_id", None)
-                            if custom_emoji_id:
-                                emoji = f"[custom:{custom_emoji_id}]"
-                        if not emoji:
-                            emoji = "[unknown]"
-                        count = getattr(reaction, "count", None)
-                        chosen = emoji in outgoing_emojis
-                        msg_dict['reactions'].append({
-                            'emoji': emoji,
-                            'count': count,
-                            'chosen': chosen
-                        })
+            # .results entries keep it in .reaction, fork entries in .type
+            reaction_type = getattr(reaction, "reaction", None) or getattr(reaction, "type", None)
+            emoji = getattr(reaction_type, "emoji", None)
+            if not emoji:
+                custom_emoji_id = getattr(reaction_type, "custom_emoji_id", None)
+                if custom_emoji_id:
+                    emoji = f"[custom:{custom_emoji_id}]"
         except Exception:
-            pass
+            emoji = None
+        return emoji or "[unknown]"
 
-        return msg_dict
+    async def _attach_reply_info(self, chat_id: str, messages_data: List[Dict], chunk_size: int = 200):
+        """Add reply information to messages, fetching every replied message once in bulk"""
+        reply_ids = sorted({msg['reply_to_message_id'] for msg in messages_data if 'error' not in msg and msg.get('reply_to_message_id')})
+        if not reply_ids:
+            return
+
+        chunks = [reply_ids[i:i + chunk_size] for i in range(0, len(reply_ids), chunk_size)]
+        results = await asyncio.gather(*[self._limited_call(self._rpc_semaphore, self.client.get_messages, chat_id=chat_id, message_ids=chunk_ids, replies=0) for chunk_ids in chunks], return_exceptions=True)
+
+        replied_messages = {}
+        for chunk_ids, result in zip(chunks, results):
+            if isinstance(result, Exception):
+                print(f"Could not get reply info for messages {chunk_ids[0]}-{chunk_ids[-1]}: {result}")
+                continue
+            replied_messages.update((message.id, message) for message in result if message is not None)
 
-    async def _get_reply_info(self, message) -> Optional[Dict]:
+        for msg in messages_data:
+            reply_to_message_id = msg.get('reply_to_message_id')
+            if reply_to_message_id and 'error' not in msg:
+                reply_info = self._get_reply_info(replied_messages.get(reply_to_message_id))
+                if reply_info:
+                    msg['reply_to'] = reply_info
+
+    def _get_reply_info(self, replied_message) -> Optional[Dict]:
         """Get information about the message being replied to"""
-        if not message.reply_to_message_id:
-            return None
-        
-        try:
-            replied_message = await self.client.get_messages(chat_id=message.chat.id, message_ids=message.reply_to_message_id)
-            if replied_message and not replied_message.empty:
-                return {
-                    'message_id': replied_message.id,
-                    'date': replied_message.date.isoformat() if replied_message.date else None,
-                    'text_preview': (replied_message.text[:100] + '...') if replied_message.text and len(replied_message.text) > 100 else replied_message.text,
-                    'from_user': replied_message.from_user.first_name if replied_message.from_user else 'Channel',
-                    'media_type': self._get_media_type(replied_message)
-                }
-        except Exception as e:
-            print(f"Could not get reply info for message {message.reply_to_message_id}: {e}")
-        
+        if replied_message and not replied_message.empty:
+            return {
+                'message_id': replied_message.id,
+                'date': replied_message.date.isoformat() if replied_message.date else None,
+                'text_preview': (replied_message.text[:100] + '...') if replied_message.text and len(replied_message.text) > 100 else replied_message.text,
+                'from_user': replied_message.from_user.first_name if replied_message.from_user else 'Channel',
+                'media_type': self._get_media_type(replied_message)
+            }
         return None
 
     def _get_media_type(self, message) -> Optional[str]:
         """Get media type from message"""
-        if message.photo: return 'photo'
-        elif message.video: return 'video'
-        elif message.audio: return 'audio'
-        elif message.voice: return 'voice'
-        elif message.document: return 'document'
-        elif message.sticker: return 'sticker'
+        for media_type, _ in _MEDIA_EXTRACTORS:
+            if getattr(message, media_type, None):
+                return media_type
         return None
 
     async def _download_range_media(self, messages_data: List[Dict], downloads_dir: str) -> List[Dict]:
@@ -503,324 +885,185 @@ class MessageExporter:
         
         return media_files
 
-    def _save_json_export(self, messages_data: List[Dict], downloads_dir: str) -> str:
+    def _save_json_export(self, messages_data: List[Dict], downloads_dir: str, now: Optional[datetime] = None) -> str:
         """Save complete JSON export"""
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        json_filename = f"telegram_export_{timestamp}.json"
+        now = now or datetime.now()
+        json_filename = f"telegram_export_{now.strftime('%Y%m%d_%H%M%S')}.json"
         json_path = os.path.join(downloads_dir, json_filename)
         
-        export_data = {
-            'export_info': {
-                'export_date': datetime.now().isoformat(),
-                'total_messages': len(messages_data),
-                'exported_by': 'Telegram-Restricted-Content-Downloader'
-            },
-            'messages': messages_data
-        }
+        try:
+            with open(json_path, 'wb') as f:
+                self._write_json_export(f, self._export_info(len(messages_data), now), messages_data)
+            return json_filename
+        except Exception as e:
+            print(f"Error saving JSON file: {e}")
+            return None
+
+    async def _save_json_export_stream(self, messages: AsyncIterator[Dict], total_messages: int, downloads_dir: str) -> Optional[str]:
+        """Save a JSON export while its messages are still being fetched, one message in memory at a time"""
+        now = datetime.now()
+        json_filename = f"telegram_export_{now.strftime('%Y%m%d_%H%M%S')}.json"
+        json_path = os.path.join(downloads_dir, json_filename)
         
         try:
-            with open(json_path, 'w', encoding='utf-8') as f:
-                json.dump(export_data, f, indent=2, ensure_ascii=False, default=str)
+            with open(json_path, 'wb') as f:
+                f.write(self._json_export_head(self._export_info(total_messages, now)))
+                separator = b'\n    '
+                async for msg_data in messages:
+                    f.write(separator)
+                    f.write(self._message_json_bytes(msg_data, indent=True).replace(b'\n', b'\n    '))
+                    separator = b',\n    '
+                f.write(b']\n}' if separator == b'\n    ' else b'\n  ]\n}')
             return json_filename
         except Exception as e:
             print(f"Error saving JSON file: {e}")
             return None
 
+    def _export_info(self, total_messages: int, now: datetime) -> Dict:
+        """Export information written at the top of the JSON export"""
+        return {
+            'export_date': now.isoformat(),
+            'total_messages': total_messages,
+            'exported_by': 'Telegram-Restricted-Content-Downloader'
+        }
+
+    def _json_export_head(self, export_info: Dict) -> bytes:
+        """Opening of the export document up to the messages array, in the same layout as json.dump(indent=2)"""
+        # Encoded newlines are only layout (string newlines are escaped), so nesting is a re-indent
+        info_bytes = _dump_json_bytes(export_info, indent=True).replace(b'\n', b'\n  ')
+        return b'{\n  "export_info": ' + info_bytes + b',\n  "messages": ['
+
+    def _write_json_export(self, f, export_info: Dict, messages_data: List[Dict]):
+        """Write the export document one message at a time, in the same layout as json.dump(indent=2)"""
+        f.write(self._json_export_head(export_info))
+        separator = b'\n    '
+        for msg_bytes in self._iter_message_json_bytes(messages_data, indent=True):
+            f.write(separator)
+            f.write(msg_bytes.replace(b'\n', b'\n    '))
+            separator = b',\n    '
+        f.write(b'\n  ]\n}' if messages_data else b']\n}')
+
+    def _save_data_script(self, messages_data: List[Dict], downloads_dir: str, now: datetime) -> Optional[str]:
+        """Save the messages as a script setting window.exportMessages for the HTML export.
+        Browsers block fetch() on file:// pages but still load scripts next to the page."""
+        script_filename = f"telegram_export_{now.strftime('%Y%m%d_%H%M%S')}.js"
+        try:
+            with open(os.path.join(downloads_dir, script_filename), 'wb') as f:
+                f.write(b'window.exportMessages = [')
+                separator = b'\n'
+                for msg_bytes in self._iter_message_json_bytes(messages_data):
+                    f.write(separator)
+                    f.write(msg_bytes)
+                    separator = b',\n'
+                f.write(b'\n];\n')
+            return script_filename
+        except Exception as e:
+            print(f"Error saving export data script: {e}")
+            return None
+
+    def _iter_message_json_bytes(self, messages_data: List[Dict], indent: bool = False) -> Iterator[bytes]:
+        """Yield the JSON bytes of every message"""
+        for msg_data in messages_data:
+            yield self._message_json_bytes(msg_data, indent)
+
+    def _message_json_bytes(self, msg_data: Dict, indent: bool = False) -> bytes:
+        """JSON bytes of one message, replaced by an error placeholder if it cannot be serialized"""
+        try:
+            return _dump_json_bytes(msg_data, indent=indent)
+        except Exception as e:
+            msg_id = msg_data.get('id')
+            return _dump_json_bytes(_error_placeholder(msg_id, f"Could not serialize message {msg_id}: {e}", msg_data.get('date')), indent=indent)
+
     def _parse_message_link(self, link: str) -> Dict[str, Any]:
         """Parse Telegram message link to extract chat_id and message_id"""
-        try:
-            if link.startswith("https://t.me/c/"):
-                base = link.split("https://t.me/c/")[-1]
-                parts = base.split("/")
-                chat_id = int(f"-100{parts[0]}")
-                message_id = int(parts[1].split("?")[0] if "?" in parts[1] else parts[1])
-            else:
-                base = link.split("https://t.me/")[-1]
-                parts = base.split("/")
-                chat_id = parts[0]
-                message_id = int(parts[1].split("?")[0] if "?" in parts[1] else parts[1])
-            
-            return {'chat_id': chat_id, 'message_id': message_id}
-        except:
+        match = _MESSAGE_LINK_RE.match(link)
+        if not match:
             return None
+        chat_id = int(f"-100{match['cid']}") if match['cid'] else match['uname']
+        return {'chat_id': chat_id, 'message_id': int(match['mid'])}
     
-    # --- RTL detection helper ---
-    def _is_rtl_text(self, text: str) -> bool:
-        """
-        Detect if the text is mostly Arabic/Persian and should be rendered RTL.
-        """
-        if not text:
-            return False
-        rtl_chars = 0
-        total_chars = 0
-        for c in text:
-            # Arabic and Persian Unicode blocks
-            if (
-                '\u0600' <= c <= '\u06FF' or  # Arabic
-                '\u0750' <= c <= '\u077F' or  # Arabic Supplement
-                '\u08A0' <= c <= '\u08FF' or  # Arabic Extended-A
-                '\uFB50' <= c <= '\uFDFF' or  # Arabic Presentation Forms-A
-                '\uFE70' <= c <= '\uFEFF' or  # Arabic Presentation Forms-B
-                '\u200F' == c                 # RTL mark
-            ):
-                rtl_chars += 1
-            if c.isalpha():
-                total_chars += 1
-        # If first non-space char is RTL, or >40% of letters are RTL, treat as RTL
-        first_nonspace = next((ch for ch in text if not ch.isspace()), '')
-        first_is_rtl = (
-            '\u0600' <= first_nonspace <= '\u06FF' or
-            '\u0750' <= first_nonspace <= '\u077F' or
-            '\u08A0' <= first_nonspace <= '\u08FF' or
-            '\uFB50' <= first_nonspace <= '\uFDFF' or
-            '\uFE70' <= first_nonspace <= '\uFEFF' or
-            '\u200F' == first_nonspace
-        )
-        if total_chars == 0:
-            return False
-        rtl_ratio = rtl_chars / total_chars
-        return first_is_rtl or rtl_ratio > 0.4
-
-    def _generate_enhanced_html_export(self, messages_data: List[Dict], media_files: List[Dict], downloads_dir: str, start_link: str, end_link: str) -> str:
+    def _generate_enhanced_html_export(self, messages_data: List[Dict], media_files: List[Dict], downloads_dir: str, start_link: str, end_link: str, data_filename: Optional[str] = None, now: Optional[datetime] = None) -> str:
         """Generate enhanced HTML file with external CSS and JS references"""
+        html_path = None
         try:
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            now = now or datetime.now()
+            timestamp = now.strftime("%Y%m%d_%H%M%S")
             html_filename = f"telegram_export_{timestamp}.html"
             html_path = os.path.join(downloads_dir, html_filename)
             
-            media_lookup = {item['message_id']: item['path'] for item in media_files}
-            message_ids = [msg['id'] for msg in messages_data if 'error' not in msg]
-            
-            # Count failed and successful messages
-            failed_messages = [msg for msg in messages_data if 'error' in msg]
-            successful_messages = [msg for msg in messages_data if 'error' not in msg]
-            service_messages = [msg for msg in successful_messages if msg.get('is_service')]
-            
-            # HTML header with external CSS and JS references
-            html_content = f'''<!DOCTYPE html>
+            # Always try to write the HTML file, even if there were errors
+            with open(html_path, 'w', encoding='utf-8', buffering=1 << 20) as f:
+                f.writelines(self._iter_html_export(messages_data, media_files, downloads_dir, start_link, end_link, data_filename, now))
+            return html_filename
+        except Exception as e:
+            print(f"HTML generation failed: {e}")
+            # Don't leave a half-written export behind
+            if html_path and os.path.exists(html_path):
+                os.remove(html_path)
+            # Create emergency HTML if normal generation fails
+            return self._create_emergency_html(start_link, end_link, f"HTML generation error: {e}", downloads_dir)
+
+    def _iter_html_export(self, messages_data: List[Dict], media_files: List[Dict], downloads_dir: str, start_link: str, end_link: str, data_filename: Optional[str], now: datetime) -> Iterator[str]:
+        """Yield the HTML export document fragment by fragment"""
+        media_lookup = {item['message_id']: item['path'] for item in media_files}
+        # .gif names per media directory, listed once instead of a stat per video
+        gif_names_by_dir = {media_dir: _gif_basenames(media_dir or os.curdir) for media_dir in {os.path.dirname(path) for path in media_lookup.values()}}
+        
+        # Count all statistics in one pass, the header needs them before any message is rendered
+        message_ids = set()
+        successful_count = 0
+        service_count = 0
+        text_only_count = 0
+        reply_count = 0
+        for msg in messages_data:
+            if 'error' in msg:
+                continue
+            message_ids.add(msg['id'])
+            successful_count += 1
+            if msg.get('reply_to'):
+                reply_count += 1
+            if msg.get('is_service'):
+                service_count += 1
+            elif (msg.get('text') or msg.get('caption')) and not msg.get('media_type'):
+                text_only_count += 1
+        failed_count = len(messages_data) - successful_count
+        
+        # HTML header with external CSS and JS references
+        yield f'''<!DOCTYPE html>
 <html>
 <head>
     <meta charset="UTF-8">
     <title>Telegram Export with JSON Data</title>
     <link rel="stylesheet" href="export_styles.css">
 </head>
-<body>
+<body data-messages-file="{data_filename or ''}">
     <h1>Telegram Messages Export with JSON Data</h1>
     <div class="export-info">
         <h2>Export Information</h2>
-        <p><strong>Export Date:</strong> {datetime.now().strftime("%Y-%m-%d %H:%M:%S")}</p>
+        <p><strong>Export Date:</strong> {now.strftime("%Y-%m-%d %H:%M:%S")}</p>
         <p><strong>Start Link:</strong> <a href="{start_link}" target="_blank">{start_link}</a></p>
         <p><strong>End Link:</strong> <a href="{end_link}" target="_blank">{end_link}</a></p>
         <p><strong>Total Messages:</strong> {len(messages_data)}</p>
-        <p><strong>Successful:</strong> {len(successful_messages)}</p>
-        <p><strong>Service Messages:</strong> {len(service_messages)}</p>
-        <p><strong>Failed:</strong> {len(failed_messages)}</p>
+        <p><strong>Successful:</strong> {successful_count}</p>
+        <p><strong>Service Messages:</strong> {service_count}</p>
+        <p><strong>Failed:</strong> {failed_count}</p>
     </div>
     <h2>Messages</h2>'''
-            
-            for msg_data in messages_data:
-                # If this is an error/log placeholder, render with clickable failed link
-                if 'error' in msg_data:
-                    html_content += (
-                        f'<div class="message" id="msg-{msg_data["id"]}" style="background:#ffeaea;border:1px solid #ff8888;">'
-                        f'<div class="message-header" style="color:#b71c1c;">Message ID: {msg_data["id"]} | ERROR</div>'
-                        f'<div class="message-text" style="color:#b71c1c;"><b>Error:</b> {msg_data.get("error", "Unknown error")}</div>'
-                        f'<div style="margin-top:10px;"><strong>Check manually:</strong> <a href="{self._reconstruct_message_link(msg_data, start_link)}" target="_blank" style="color:#0088cc;">{self._reconstruct_message_link(msg_data, start_link)}</a></div>'
-                        f'</div>'
-                    )
-                    continue
-
-                # Handle service messages with special styling
-                if msg_data.get('is_service'):
-                    service_text = msg_data.get('service_text', 'Service message')
-                    service_type = msg_data.get('service_type', 'Unknown')
-                    service_type_class = msg_data.get('service_type_class', '')
-                    msg_date = msg_data.get('date', 'Unknown')
-                    html_content += f'<div class="message service-message" id="msg-{msg_data["id"]}">'
-                    html_content += (
-                        f'<div class="message-header">'
-                        f'<b>Service Message</b> | ID: {msg_data["id"]} | Date: {msg_date} | '
-                        f'<span style="color:#0088cc;">Type: {service_type}'
-                    )
-                    if service_type_class and service_type_class != service_type:
-                        html_content += f' <span style="color:#888;">({service_type_class})</span>'
-                    html_content += '</span></div>'
-
-                    # --- Show details for PINNED_MESSAGE and NEW_CHAT_MEMBERS ---
-                    # We need to check the original message object for these fields
-                    # Find the original message object in messages_data (if available)
-                    original_message = None
-                    if 'original_message_obj' in msg_data:
-                        original_message = msg_data['original_message_obj']
-                    # If not present, skip (for future extension)
-
-                    # For PINNED_MESSAGE, show info about the pinned message
-                    if service_type == "PINNED_MESSAGE":
-                        # Try to get pinned_message info from msg_data if available
-                        pinned_info = ""
-                        try:
-                            # If you want to show the pinned message text, you need to fetch it from the message object
-                            # But here, we only have the dict, so we can't fetch it unless you store it in msg_data
-                            # So, recommend to add this in _message_to_dict if needed
-                            pinned_message_id = None
-                            if hasattr(original_message, "pinned_message") and original_message.pinned_message:
-                                pinned_message_id = getattr(original_message.pinned_message, "id", None)
-                                pinned_text = getattr(original_message.pinned_message, "text", None)
-                                pinned_caption = getattr(original_message.pinned_message, "caption", None)
-                                pinned_content = pinned_text or pinned_caption or ""
-                                pinned_info = f'<div><b>Pinned Message ID:</b> {pinned_message_id}</div>'
-                                if pinned_content:
-                                    pinned_info += f'<div><b>Pinned Content:</b> {pinned_content}</div>'
-                            elif "pinned_message_id" in msg_data:
-                                pinned_info = f'<div><b>Pinned Message ID:</b> {msg_data["pinned_message_id"]}</div>'
-                        except Exception:
-                            pass
-                        if pinned_info:
-                            html_content += f'<div class="service-text" style="background:#e3f2fd;">{pinned_info}</div>'
-
-                    # For NEW_CHAT_MEMBERS, show info about the new members
-                    if service_type == "NEW_CHAT_MEMBERS":
-                        members_info = ""
-                        try:
-                            if hasattr(original_message, "new_chat_members") and original_message.new_chat_members:
-                                members = original_message.new_chat_members
-                                members_info = "<div><b>New Members Joined:</b> " + ", ".join(
-                                    [getattr(u, "first_name", "Unknown") for u in members]
-                                ) + "</div>"
-                        except Exception:
-                            pass
-                        if members_info:
-                            html_content += f'<div class="service-text" style="background:#e3f2fd;">{members_info}</div>'
-
-                    html_content += f'<div class="service-text">{service_text}</div>'
-                    # JSON toggle button and data for service messages
-                    try:
-                        json_data_str = json.dumps(msg_data, indent=2, ensure_ascii=False, default=str)
-                    except Exception as e:
-                        json_data_str = f"Could not serialize message: {e}"
-                    html_content += f'<div class="json-toggle" onclick="toggleJson({msg_data["id"]})">Show/Hide JSON Data</div><div id="json-{msg_data["id"]}" class="json-data">{json_data_str}</div></div>'
-                    continue
-
-                # Compose sender display: Name (id) [@username]
-                from_user = msg_data.get('from_user')
-                if from_user:
-                    sender_name = from_user.get('first_name') or from_user.get('last_name') or from_user.get('username') or "Deleted Account"
-                    sender_id = from_user.get('id')
-                    sender_username = from_user.get('username')
-                else:
-                    sender_name = "Deleted Account"
-                    sender_id = None
-                    sender_username = None
-
-                sender_info = sender_name
-                if sender_id is not None:
-                    sender_info += f' (id: {sender_id})'
-                if sender_username:
-                    sender_info += f' [@{sender_username}]'
-
-                msg_date = msg_data.get('date', 'Unknown')
-                
-                html_content += f'<div class="message" id="msg-{msg_data["id"]}"><div class="message-header">Message ID: {msg_data["id"]} | Date: {msg_date} | From: {sender_info}'
-                
-                if msg_data.get('media_type'):
-                    html_content += f' | Media: {msg_data["media_type"]}'
-                
-                html_content += '</div>'
-                
-                # Show reply information with clickable functionality
-                if msg_data.get('reply_to'):
-                    reply = msg_data['reply_to']
-                    reply_msg_id = reply['message_id']
-                    is_in_range = reply_msg_id in message_ids
-                    
-                    if is_in_range:
-                        html_content += f'<div class="reply-info" data-reply-to="{reply_msg_id}" title="Click to scroll to replied message"><strong>↳ Replying to message {reply_msg_id}</strong> by {reply["from_user"]}<div class="reply-preview">{reply.get("text_preview", "")}</div></div>'
-                    else:
-                        html_content += f'<div class="reply-info"><strong>↳ Replying to message {reply_msg_id}</strong> by {reply["from_user"]} <span style="color:#888;">(not in export range)</span><div class="reply-preview">{reply.get("text_preview", "")}</div></div>'
-                
-                # Message text
-                if msg_data.get('text') or msg_data.get('caption'):
-                    text_content = msg_data.get('text') or msg_data.get('caption')
-                    escaped_text = text_content.replace('<', '&lt;').replace('>', '&gt;').replace('\n', '<br>')
-                    # RTL detection
-                    if self._is_rtl_text(text_content):
-                        html_content += f'<div class="message-text" dir="rtl" style="text-align:right">{escaped_text}</div>'
-                    else:
-                        html_content += f'<div class="message-text">{escaped_text}</div>'
-                
-                # Media content
-                if msg_data['id'] in media_lookup:
-                    media_path = media_lookup[msg_data['id']]
-                    filename = os.path.basename(media_path)
-                    file_ext = filename.lower().split('.')[-1] if '.' in filename else ''
-                    relative_path = os.path.relpath(media_path, downloads_dir).replace('\\', '/')
-
-                    # --- Sticker and animation/gif support ---
-                    # Fixed stickers are webp, animated stickers are webm, GIFs are gif/mp4 (prefer gif if available)
-                    if file_ext in ['jpg', 'jpeg', 'png']:
-                        html_content += f'<div class="message-media"><img src="{relative_path}" alt="Image"></div>'
-                    elif file_ext == 'webp':
-                        # Fixed sticker (static)
-                        html_content += f'<div class="message-media"><img src="{relative_path}" alt="Sticker" style="max-width:128px;background:#eee;"><div class="media-info">Sticker (.webp)</div></div>'
-                    elif file_ext in ['mp4', 'webm']:
-                        # mp4/webm can be video, animated sticker, or gif (Telegram GIFs are mp4, but if .gif exists, prefer .gif)
-                        # Check if a .gif file exists for this media (same base name)
-                        gif_path = os.path.splitext(media_path)[0] + ".gif"
-                        gif_rel = os.path.relpath(gif_path, downloads_dir).replace('\\', '/')
-                        if os.path.exists(gif_path):
-                            html_content += f'<div class="message-media"><img src="{gif_rel}" alt="GIF"></div>'
-                        elif msg_data.get('media_type') == 'sticker':
-                            html_content += f'<div class="message-media"><video autoplay loop muted playsinline style="background:#eee;max-width:128px;"><source src="{relative_path}" type="video/{file_ext}">Your browser does not support animated stickers.</video><div class="media-info">Animated Sticker (.{file_ext})</div></div>'
-                        else:
-                            html_content += f'<div class="message-media"><video controls loop autoplay muted playsinline><source src="{relative_path}" type="video/{file_ext}">Your browser does not support video or GIFs. (Telegram GIFs are mp4 files)</video></div>'
-                    elif file_ext == 'gif':
-                        html_content += f'<div class="message-media"><img src="{relative_path}" alt="GIF"></div>'
-                    elif file_ext == 'tgs':
-                        # Lottie animation, not viewable in browser
-                        html_content += f'<div class="media-file">🗂️ <a href="{relative_path}" target="_blank">{filename}</a> <span class="media-info">(Telegram animated sticker .tgs - not viewable in browser)</span></div>'
-                    elif file_ext in ['mp3', 'wav', 'ogg', 'opus', 'oga']:
-                        audio_type = "audio/ogg" if file_ext == "oga" else f"audio/{file_ext}"
-                        html_content += f'<div class="message-media"><audio controls><source src="{relative_path}" type="{audio_type}">Your browser does not support audio.</audio></div>'
-                    else:
-                        html_content += f'<div class="media-file">📁 <a href="{relative_path}" target="_blank">{filename}</a></div>'
-
-                    # Add media info
-                    if msg_data.get('media_info'):
-                        media_info = msg_data['media_info']
-                        info_text = f"File size: {media_info.get('file_size', 'Unknown')}"
-                        if media_info.get('duration'):
-                            info_text += f" | Duration: {media_info['duration']}s"
-                        html_content += f'<div class="media-info">{info_text}</div>'
-                
-                # Show reactions if present and not empty
-                if msg_data.get('reactions') and len(msg_data['reactions']) > 0:
-                    html_content += '<div class="message-reactions" style="margin-bottom:8px;">'
-                    for reaction in msg_data['reactions']:
-                        emoji = reaction.get('emoji', '')
-                        count = reaction.get('count', 0)
-                        chosen = reaction.get('chosen', False)
-                        chosen_style = 'border:2px solid #0088cc;border-radius:50%;padding:2px;' if chosen else ''
-                        html_content += f'<span style="display:inline-block;margin-right:8px;font-size:18px;{chosen_style}">{emoji} <span style="font-size:13px;color:#555;">{count}</span></span>'
-                    html_content += '</div>'
-
-                # JSON toggle button and data
-                try:
-                    json_data_str = json.dumps(msg_data, indent=2, ensure_ascii=False, default=str)
-                except Exception as e:
-                    json_data_str = f"Could not serialize message: {e}"
-                html_content += f'<div class="json-toggle" onclick="toggleJson({msg_data["id"]})">Show/Hide JSON Data</div><div id="json-{msg_data["id"]}" class="json-data">{json_data_str}</div></div>'
-            
-            # Add statistics and close HTML with external JS reference
-            media_count = len(media_files)
-            text_only_count = len([m for m in successful_messages if (m.get('text') or m.get('caption')) and not m.get('media_type') and not m.get('is_service')])
-            reply_count = len([m for m in successful_messages if m.get('reply_to')])
-            
-            html_content += f'''<div class="stats">
+        
+        # Absolute export dir with a trailing separator, media paths under it only need the prefix cut off
+        downloads_prefix = os.path.join(os.path.abspath(downloads_dir), '')
+        for msg_data in messages_data:
+            yield _render_message(msg_data, media_lookup, message_ids, downloads_prefix, start_link, gif_names_by_dir)
+        
+        # Add statistics and close HTML with external JS reference
+        media_count = len(media_files)
+        
+        yield f'''<div class="stats">
     <h2>Export Statistics</h2>
     <p>Total Messages: {len(messages_data)}</p>
-    <p>Successfully Exported: {len(successful_messages)}</p>
-    <p>Service Messages: {len(service_messages)}</p>
-    <p>Failed Messages: {len(failed_messages)}</p>
+    <p>Successfully Exported: {successful_count}</p>
+    <p>Service Messages: {service_count}</p>
+    <p>Failed Messages: {failed_count}</p>
     <p>Messages with Media: {media_count}</p>
     <p>Text-only Messages: {text_only_count}</p>
     <p>Reply Messages: {reply_count}</p>
@@ -828,27 +1071,3 @@ class MessageExporter:
 <script src="export_scripts.js"></script>
 </body>
 </html>'''
-            
-            # Always try to write the HTML file, even if there were errors
-            with open(html_path, 'w', encoding='utf-8') as f:
-                f.write(html_content)
-            return html_filename
-        except Exception as e:
-            print(f"HTML generation failed: {e}")
-            # Create emergency HTML if normal generation fails
-            return self._create_emergency_html(start_link, end_link, f"HTML generation error: {e}", downloads_dir)
-
-    def _reconstruct_message_link(self, msg_data: Dict, start_link: str) -> str:
-        """Reconstruct message link for failed messages"""
-        chat_id = msg_data.get('chat_id') or 'unknown'
-        msg_id = msg_data['id']
-        
-        if start_link.startswith("https://t.me/c/") and str(chat_id).startswith('-100'):
-            clean_chat_id = str(chat_id)[4:] if str(chat_id).startswith('-100') else str(chat_id)
-            return f"https://t.me/c/{clean_chat_id}/{msg_id}"
-        else:
-            try:
-                username = start_link.split('https://t.me/')[-1].split('/')[0]
-                return f"https://t.me/{username}/{msg_id}"
-            except:
-                return f"Message ID: {msg_id}"
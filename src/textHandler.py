@@ -1,23 +1,84 @@
 import os
 import re
 from datetime import datetime
+from functools import lru_cache
 from typing import Optional
 
+# Characters that are not allowed in Windows (and therefore portable) file names
+_INVALID_FILENAME_CHARS = re.compile(r'[<>:"/\\|?*]')
+
+# Create a new file, failing if it exists. O_BINARY keeps Windows from translating newlines
+# a second time below the text layer of open()
+_NEW_FILE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, 'O_BINARY', 0)
+
+# Line between the header and the text of a saved file
+_SEP_LINE = "-" * 50 + "\n\n"
+
+# Message attributes that carry media content
+_MEDIA_ATTRS = ('photo', 'video', 'audio', 'document', 'animation', 'voice', 'video_note', 'sticker', 'contact', 'location')
+
+
+def _clean_filename_text(text: str) -> str:
+    """Replace invalid characters and collapse whitespace and newlines to single spaces"""
+    return ' '.join(_INVALID_FILENAME_CHARS.sub('_', text).split())
+
+def _chat_add_user_text(service) -> str:
+    user_names = [TextHandler._get_user_display_name(user) for user in getattr(service, 'users', [])]
+    if user_names:
+        return f"👥 {', '.join(user_names)} joined the group"
+    return "👥 Someone joined the group"
+
+
+def _chat_delete_user_text(service) -> str:
+    user = getattr(service, 'user', None)
+    user_name = TextHandler._get_user_display_name(user) if user else "Someone"
+    return f"👋 {user_name} left the group"
+
+
+# Service class name -> text of the service message
+_SERVICE_TEXT_HANDLERS = {
+    "MessageServiceChatAddUser": _chat_add_user_text,
+    "MessageServiceChatDeleteUser": _chat_delete_user_text,
+    "MessageServicePinMessage": lambda service: "📌 Message was pinned",
+    "MessageServiceChatEditTitle": lambda service: f"✏️ Group title changed to: {getattr(service, 'title', 'Unknown')}",
+    "MessageServiceChatEditPhoto": lambda service: "🖼️ Group photo was changed",
+    "MessageServiceChatDeletePhoto": lambda service: "🗑️ Group photo was removed",
+    "MessageServiceChatCreate": lambda service: f"🎉 Group '{getattr(service, 'title', 'Unknown')}' was created",
+    "MessageServiceChatMigrateTo": lambda service: "📤 Group was migrated to supergroup",
+    "MessageServiceChatMigrateFrom": lambda service: "📥 Group was migrated from basic group",
+    "MessageServiceChannelCreate": lambda service: f"📢 Channel '{getattr(service, 'title', 'Unknown')}' was created",
+    "MessageServiceChannelMigrateFrom": lambda service: "📥 Channel was migrated from group",
+    "MessageServiceWebViewDataSent": lambda service: "🌐 Web app data was sent",
+    "MessageServicePaymentSent": lambda service: "💳 Payment was sent",
+    "MessageServiceContactRegistered": lambda service: "📱 Contact joined Telegram",
+    "MessageServiceGiftedPremium": lambda service: "🎁 Premium subscription was gifted",
+}
+
+# Service class -> handler (or None), resolved from the name table once per class
+_service_handlers_by_class = {}
+
 class TextHandler:
     @staticmethod
+    @lru_cache(maxsize=256)
     def sanitize_filename(text: str, max_length: int = 50) -> str:
         """
-        Sanitize text to create a valid filename
+        Sanitize text to create a valid filename of at most max_length UTF-8 bytes
+        Cached, since pinned notices and repeated captions produce the same name again and again
         """
-        # Remove or replace invalid characters
-        sanitized = re.sub(r'[<>:"/\\|?*]', '_', text)
-        
-        # Remove extra whitespace and newlines
-        sanitized = ' '.join(sanitized.split())
+        # Only the start of the text ends up in the name, so clean a bounded prefix first
+        # and fall back to the whole text if whitespace collapsing left it too short
+        prefix_length = max_length * 4
+        if 0 < prefix_length < len(text):
+            sanitized = _clean_filename_text(text[:prefix_length])
+            if len(sanitized) < max_length:
+                sanitized = _clean_filename_text(text)
+        else:
+            sanitized = _clean_filename_text(text)
         
-        # Truncate if too long
-        if len(sanitized) > max_length:
-            sanitized = sanitized[:max_length].rstrip()
+        # Truncate if too long, by UTF-8 bytes since filesystems limit name length in bytes
+        encoded = sanitized.encode('utf-8')
+        if len(encoded) > max_length:
+            sanitized = encoded[:max_length].decode('utf-8', 'ignore').rstrip()
         
         # Ensure it's not empty
         if not sanitized.strip():
@@ -35,29 +96,33 @@ class TextHandler:
             return None
         
         # Create downloads directory if it doesn't exist
-        if not os.path.exists(downloads_dir):
-            os.makedirs(downloads_dir)
+        os.makedirs(downloads_dir, exist_ok=True)
         
-        # Create filename based on content preview and timestamp
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # Create filename based on content preview and timestamp, one clock read for the name and the header
+        now = datetime.now()
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
         content_preview = TextHandler.sanitize_filename(text)
         filename = f"{timestamp}_{content_preview}.txt"
         
         filepath = os.path.join(downloads_dir, filename)
         
-        # Ensure unique filename
-        counter = 1
-        while os.path.exists(filepath):
-            base_name = f"{timestamp}_{content_preview}_{counter}.txt"
-            filepath = os.path.join(downloads_dir, base_name)
-            counter += 1
-        
         try:
-            with open(filepath, 'w', encoding='utf-8') as f:
-                f.write(f"Source: {link}\n")
-                f.write(f"Downloaded: {datetime.now().strftime('%Y-%m-%d %H:%M:%S UTC')}\n")
-                f.write("-" * 50 + "\n\n")
-                f.write(text)
+            # Ensure unique filename, O_EXCL only creates the file if the name is still free
+            counter = 1
+            while True:
+                try:
+                    fd = os.open(filepath, _NEW_FILE_FLAGS, 0o644)
+                    break
+                except FileExistsError:
+                    base_name = f"{timestamp}_{content_preview}_{counter}.txt"
+                    filepath = os.path.join(downloads_dir, base_name)
+                    counter += 1
+            
+            # 64 KiB buffer so typical posts go out in a single write
+            with open(fd, 'w', encoding='utf-8', buffering=1 << 16) as f:
+                # Header and text in one call, without concatenating a copy of the text
+                header = f"Source: {link}\nDownloaded: {now.strftime('%Y-%m-%d %H:%M:%S UTC')}\n{_SEP_LINE}"
+                f.writelines((header, text))
             
             return os.path.basename(filepath)
         
@@ -71,100 +136,54 @@ class TextHandler:
         Extract text content from a Telegram message including service messages
         Returns the text if found, None otherwise
         """
-        text_content = ""
+        text = getattr(message, 'text', None)
+        caption = getattr(message, 'caption', None)
+        
+        # Media-only messages carry none of these, skip the service dispatch for them
+        if not (text or caption or getattr(message, 'service', None)):
+            return None
+        
+        parts = []
         
         # Check for service message first
         service_text = TextHandler.extract_service_message_text(message)
         if service_text:
-            text_content = service_text
+            parts.append(service_text)
         
         # Check for regular message text
-        elif hasattr(message, 'text') and message.text:
-            text_content += message.text
+        elif text:
+            parts.append(text)
         
         # Check for caption (text attached to media)
-        if hasattr(message, 'caption') and message.caption:
-            if text_content:
-                text_content += "\n\n" + message.caption
-            else:
-                text_content = message.caption
+        if caption:
+            parts.append(caption)
         
-        return text_content.strip() if text_content.strip() else None
+        # Joined once, a single part is returned by join as is
+        stripped = "\n\n".join(parts).strip()
+        return stripped if stripped else None
 
     @staticmethod
     def extract_service_message_text(message) -> Optional[str]:
         """
         Extract text from service messages (system notifications)
         """
-        if not hasattr(message, 'service'):
-            return None
-            
-        service = message.service
+        service = getattr(message, 'service', None)
         if not service:
             return None
             
         # Handle different service message types
-        service_type = type(service).__name__
+        service_class = type(service)
+        try:
+            handler = _service_handlers_by_class[service_class]
+        except KeyError:
+            handler = _service_handlers_by_class[service_class] = _SERVICE_TEXT_HANDLERS.get(service_class.__name__)
+        
+        if handler is None:
+            # Generic service message
+            return f"ℹ️ Service message: {service_class.__name__}"
         
         try:
-            if service_type == "MessageServiceChatAddUser":
-                users = service.users if hasattr(service, 'users') else []
-                user_names = [TextHandler._get_user_display_name(user) for user in users]
-                if user_names:
-                    return f"👥 {', '.join(user_names)} joined the group"
-                return "👥 Someone joined the group"
-                
-            elif service_type == "MessageServiceChatDeleteUser":
-                user = service.user if hasattr(service, 'user') else None
-                user_name = TextHandler._get_user_display_name(user) if user else "Someone"
-                return f"👋 {user_name} left the group"
-                
-            elif service_type == "MessageServicePinMessage":
-                return "📌 Message was pinned"
-                
-            elif service_type == "MessageServiceChatEditTitle":
-                title = service.title if hasattr(service, 'title') else "Unknown"
-                return f"✏️ Group title changed to: {title}"
-                
-            elif service_type == "MessageServiceChatEditPhoto":
-                return "🖼️ Group photo was changed"
-                
-            elif service_type == "MessageServiceChatDeletePhoto":
-                return "🗑️ Group photo was removed"
-                
-            elif service_type == "MessageServiceChatCreate":
-                title = service.title if hasattr(service, 'title') else "Unknown"
-                return f"🎉 Group '{title}' was created"
-                
-            elif service_type == "MessageServiceChatMigrateTo":
-                return "📤 Group was migrated to supergroup"
-                
-            elif service_type == "MessageServiceChatMigrateFrom":
-                return "📥 Group was migrated from basic group"
-                
-            elif service_type == "MessageServiceChannelCreate":
-                title = service.title if hasattr(service, 'title') else "Unknown"
-                return f"📢 Channel '{title}' was created"
-                
-            elif service_type == "MessageServiceChannelMigrateFrom":
-                return "📥 Channel was migrated from group"
-                
-            elif service_type == "MessageServiceWebViewDataSent":
-                return "🌐 Web app data was sent"
-                
-            elif service_type == "MessageServicePaymentSent":
-                return "💳 Payment was sent"
-                
-            elif service_type == "MessageServiceContactRegistered":
-                return "📱 Contact joined Telegram"
-                
-            elif service_type == "MessageServiceGiftedPremium":
-                return "🎁 Premium subscription was gifted"
-                
-            else:
-                # Generic service message
-                return f"ℹ️ Service message: {service_type}"
-                
+            return handler(service)
         except Exception as e:
             return f"ℹ️ Service message (parsing error: {e})"
 
@@ -176,38 +195,29 @@ class TextHandler:
         if not user:
             return "Unknown User"
             
-        name_parts = []
-        if hasattr(user, 'first_name') and user.first_name:
-            name_parts.append(user.first_name)
-        if hasattr(user, 'last_name') and user.last_name:
-            name_parts.append(user.last_name)
-            
-        if name_parts:
-            return " ".join(name_parts)
-        elif hasattr(user, 'username') and user.username:
-            return f"@{user.username}"
-        else:
-            return "Unknown User"
+        first_name = getattr(user, 'first_name', None)
+        last_name = getattr(user, 'last_name', None)
+        if first_name and last_name:
+            return f"{first_name} {last_name}"
+        if first_name:
+            return first_name
+        if last_name:
+            return last_name
+        username = getattr(user, 'username', None)
+        if username:
+            return f"@{username}"
+        return "Unknown User"
 
     @staticmethod
     def is_service_message(message) -> bool:
         """
         Check if message is a service message
         """
-        return hasattr(message, 'service') and message.service is not None
+        return getattr(message, 'service', None) is not None
 
     @staticmethod
     def has_media_content(message) -> bool:
         """
         Check if message contains media content (photo, video, audio, document, etc.)
         """
-        media_attributes = [
-            'photo', 'video', 'audio', 'document', 'animation', 
-            'voice', 'video_note', 'sticker', 'contact', 'location'
-        ]
-        
-        for attr in media_attributes:
-            if hasattr(message, attr) and getattr(message, attr):
-                return True
-        
-        return False
\ No newline at end of file
+        return any(getattr(message, attr, None) for attr in _MEDIA_ATTRS)
\ No newline at end of file